@@ -2,11 +2,17 @@
 
 import os
 import logging
+import multiprocessing
 import re
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from io import StringIO
+import numpy as np
 import pandas as pd
-import pdfplumber
+import pymupdf
 from PIL import Image
 import pytesseract
 from flask import Flask, request, render_template, redirect, url_for, session, make_response
@@ -17,10 +23,42 @@ from flask import Flask, request, render_template, redirect, url_for, session, m
 UPLOAD_FOLDER = 'uploads'
 KNOWLEDGE_BASE_PATH = 'knowledge'
 LOGS_FOLDER = 'logs'
-VENDOR_LOOKUP_FILE = os.path.join(KNOWLEDGE_BASE_PATH, 'VendorLookup.csv')
+RESULTS_FOLDER = 'results'
+RESULTS_MAX_AGE_SECONDS = 24 * 60 * 60
 FINANCIAL_CALENDAR_FILE = os.path.join(KNOWLEDGE_BASE_PATH, 'FinancialCalendar.csv')
 LOG_FILE = os.path.join(LOGS_FOLDER, 'processor.log')
-ALLOWED_EXTENSIONS = {'pdf'}
+ALLOWED_EXTENSIONS = frozenset({'pdf'})
+# gunicorn reads WEB_CONCURRENCY for its worker count; each worker gets its own share of the cores for its PDF pool
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+PDF_POOL_WORKERS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+VENDOR_NAME = "BP AUSTRALIA"
+VENDOR_NO = "96029099"
+TRAILER_LINE_PREFIX = f"{VENDOR_NAME} 8409 "
+TRAILER_LINE_SUFFIX = " BRDC Fuel"
+SHUNT_LINE_PREFIX = f"{VENDOR_NAME} 8682 "
+SHUNT_LINE_SUFFIX = " BRDC Shunt Fuel"
+FUEL_TRACKING_COLUMNS = (
+    'Invoice', 'Invoice Date', 'excl GST', 'GST', 'incl GST', 'Delivery Date', 'FY WK', 'Docket',
+    'Total Litres QTY', 'SHUNT QTY', 'Trailer litres', 'UNIT PRICE', 'SHUNT COST', 'INVOICE DIFF',
+    'Trailer total', 'SHUNT Total', 'Uploading WK'
+)
+FUEL_TRACKING_MONEY_FORMATS = {
+    'excl GST': '%.2f', 'GST': '%.2f', 'incl GST': '%.2f', 'UNIT PRICE': '%.5f',
+    'SHUNT COST': '%.2f', 'Trailer total': '%.2f', 'SHUNT Total': '%.2f'
+}
+
+# =====================================================================================
+# REGEX PATTERNS
+# =====================================================================================
+RE_DOCKET_NO = re.compile(r"Delivery Docket No\.\s*:\s*(\d+)", re.IGNORECASE)
+RE_SHUNT_QTY = re.compile(r"ATTSHUNT.*?(\d+)", re.IGNORECASE)
+RE_INVOICE_NO = re.compile(r"Invoice Number\s*(\d+)", re.IGNORECASE)
+RE_INVOICE_DATE = re.compile(r"Invoice Date\s*(\d{2} \w{3} \d{4})", re.IGNORECASE)
+RE_SECTION = re.compile(
+    r"Delivery Docket Number / Date:\s*(\d+)\s*/\s*(\d{2} \w{3} \d{4})(.*?)(?=Delivery Docket Number / Date:|\Z)",
+    re.IGNORECASE | re.DOTALL)
+RE_RESULT_KEY = re.compile(r"[0-9a-f]{32}")
+RE_DATA_LINE = re.compile(r"(ULSD 10PPM|Diesel)\s+([\d,]+)\s+L\s+([\d.]+)\s+([\d,]+\.\d{2})", re.IGNORECASE)
 
 # =====================================================================================
 # LOGGING SETUP
@@ -29,6 +67,42 @@ if not os.path.exists(LOGS_FOLDER):
     os.makedirs(LOGS_FOLDER)
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# =====================================================================================
+# RESULTS STORAGE (combined CSVs shared by all gunicorn workers)
+# =====================================================================================
+if not os.path.exists(RESULTS_FOLDER):
+    os.makedirs(RESULTS_FOLDER)
+
+def _result_path(result_key):
+    # The key comes from the session cookie, which can be forged; only accept our own uuid4 hex keys
+    if not isinstance(result_key, str) or not RE_RESULT_KEY.fullmatch(result_key): return None
+    return os.path.join(RESULTS_FOLDER, f'{result_key}.csv')
+
+def _remove_result(result_key):
+    result_path = _result_path(result_key)
+    if not result_path: return
+    try:
+        os.remove(result_path)
+    except FileNotFoundError:
+        pass
+
+def _sweep_old_results():
+    cutoff = time.time() - RESULTS_MAX_AGE_SECONDS
+    for entry in os.scandir(RESULTS_FOLDER):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff: os.remove(entry.path)
+        except FileNotFoundError:
+            # Another worker swept it first
+            pass
+
+# =====================================================================================
+# KNOWLEDGE BASE (static lookups, loaded once per worker)
+# =====================================================================================
+_financial_calendar_df = pd.read_csv(FINANCIAL_CALENDAR_FILE)
+_financial_calendar_df['Date'] = pd.to_datetime(_financial_calendar_df['Date'], format='%d/%m/%Y')
+DATE_TO_WEEK = dict(zip(_financial_calendar_df['Date'].dt.date.tolist(), _financial_calendar_df['Week'].tolist()))
+del _financial_calendar_df
+
 # =====================================================================================
 # FLASK APP INITIALIZATION
 # =====================================================================================
@@ -37,95 +111,98 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SECRET_KEY'] = 'supersecretkeyyoushouldchange'
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    dot = filename.rfind('.')
+    return dot > 0 and filename[dot + 1:].lower() in ALLOWED_EXTENSIONS
 
 def extract_text_from_pdf(file_path):
     try:
-        with pdfplumber.open(file_path) as pdf:
-            return "".join(page.extract_text() for page in pdf.pages if page.extract_text())
+        # sort=True emits text in reading order (top-to-bottom, left-to-right) like pdfplumber did
+        with pymupdf.open(file_path) as doc:
+            return "".join(page.get_text("text", sort=True) for page in doc)
     except Exception as e:
-        logging.error(f"pdfplumber failed for {file_path}: {e}")
+        logging.error(f"PyMuPDF failed for {file_path}: {e}")
         return None
 
-def _process_shunt_docket(docket_filename):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], docket_filename)
+def _process_shunt_docket(filepath):
     text = extract_text_from_pdf(filepath)
     if not text: return None
-    docket_no_match = re.search(r"Delivery Docket No\.\s*:\s*(\d+)", text, re.IGNORECASE)
-    shunt_qty_match = re.search(r"ATTSHUNT.*?(\d+)", text, re.IGNORECASE)
+    docket_no_match = RE_DOCKET_NO.search(text)
+    shunt_qty_match = RE_SHUNT_QTY.search(text)
     if docket_no_match and shunt_qty_match:
         return {"docket_number": docket_no_match.group(1), "shunt_qty": int(shunt_qty_match.group(1))}
     return None
 
-def _process_single_invoice(invoice_filename, vendor_df, financial_calendar_df, shunt_data):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], invoice_filename)
-    text = extract_text_from_pdf(filepath)
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool():
+    # Created on first use and reused for the life of the worker. 'spawn' rather than fork so the
+    # threaded dev server can't hand a child a lock (e.g. logging's) held by another thread.
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pdf_pool
+
+def _discard_pdf_pool(pool):
+    # A pool whose child died stays broken; drop it so the next request starts a fresh one
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool: _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _derive_costs(total_litres, unit_prices, shunt_qtys):
+    trailer_litres = total_litres - shunt_qtys
+    shunt_costs = shunt_qtys * unit_prices
+    trailer_costs = trailer_litres * unit_prices
+    return trailer_litres, shunt_costs, trailer_costs, trailer_costs.sum(), shunt_costs.sum()
+
+def _parse_invoice(text, date_to_week, shunt_data):
     if not text: return None, None, None
 
     # --- Extract Header Info ---
-    vendor_name, vendor_no, invoice_no, invoice_date_obj = "BP AUSTRALIA", "96029099", "Not Found", None
-    invoice_no_match = re.search(r"Invoice Number\s*(\d+)", text, re.IGNORECASE)
+    vendor_name, vendor_no, invoice_no, invoice_date_obj = VENDOR_NAME, VENDOR_NO, "Not Found", None
+    invoice_no_match = RE_INVOICE_NO.search(text)
     if invoice_no_match: invoice_no = invoice_no_match.group(1)
-    invoice_date_match = re.search(r"Invoice Date\s*(\d{2} \w{3} \d{4})", text, re.IGNORECASE)
-    if invoice_date_match: invoice_date_obj = pd.to_datetime(invoice_date_match.group(1))
+    invoice_date_match = RE_INVOICE_DATE.search(text)
+    if invoice_date_match: invoice_date_obj = datetime.strptime(invoice_date_match.group(1), '%d %b %Y')
     invoice_date = invoice_date_obj.strftime('%d/%m/%Y') if invoice_date_obj else 'Not Found'
 
     # --- Process Line Items ---
-    fuel_tracking_rows = []
-    total_trailer_cost_excl_gst = 0
-    total_shunt_cost_excl_gst = 0
+    docket_nos, delivery_dates, fy_wks = [], [], []
+    total_litres, unit_prices, excl_gsts, shunt_qtys = [], [], [], []
     last_delivery_date = None
 
-    # Split the text by delivery docket sections
-    sections = text.split("Delivery Docket Number / Date:")[1:]
-
-    for section in sections:
-        # Extract docket number and date from the start of the section
-        header_match = re.search(r"^\s*(\d+)\s*/\s*(\d{2} \w{3} \d{4})", section, re.IGNORECASE)
-        if not header_match:
-            continue
-
-        docket_no = header_match.group(1)
-        delivery_date_str = header_match.group(2)
-        delivery_date = pd.to_datetime(delivery_date_str)
+    # Walk the delivery docket sections in a single pass over the text
+    for section_match in RE_SECTION.finditer(text):
+        docket_no, delivery_date_str, section = section_match.group(1, 2, 3)
+        delivery_date = datetime.strptime(delivery_date_str, '%d %b %Y').date()
         last_delivery_date = delivery_date
 
         # Find the financial data within this section
-        data_line_match = re.search(r"(ULSD 10PPM|Diesel)\s+([\d,]+)\s+L\s+([\d.]+)\s+([\d,]+\.\d{2})", section, re.IGNORECASE)
+        data_line_match = RE_DATA_LINE.search(section)
         if data_line_match:
-            total_litres = int(data_line_match.group(2).replace(',',''))
-            unit_price = float(data_line_match.group(3))
-            excl_gst = float(data_line_match.group(4).replace(',',''))
-
-            shunt_qty = shunt_data.get(docket_no, {}).get('shunt_qty', 0)
-            trailer_litres = total_litres - shunt_qty
-            shunt_cost = shunt_qty * unit_price
-            trailer_cost = trailer_litres * unit_price
-            total_trailer_cost_excl_gst += trailer_cost
-            total_shunt_cost_excl_gst += shunt_cost
-
-            # --- Build Fuel Tracking Row (with numeric types for costs) ---
-            fy_wk = ''
-            week_lookup_date = delivery_date.strftime('%#d/%#m/%Y')
-            week_code_row = financial_calendar_df[financial_calendar_df['Date'] == week_lookup_date]
-            if not week_code_row.empty:
-                fy_wk = week_code_row['Week'].iloc[0]
-
-            fuel_tracking_rows.append({
-                'Invoice': invoice_no, 'Invoice Date': invoice_date, 'excl GST': excl_gst, 
-                'GST': excl_gst * 0.1, 'incl GST': excl_gst * 1.1, 
-                'Delivery Date': delivery_date.strftime('%d-%b'), 'FY WK': fy_wk, 'Docket': docket_no,
-                'Total Litres QTY': total_litres, 'SHUNT QTY': shunt_qty, 'Trailer litres': trailer_litres,
-                'UNIT PRICE': unit_price, 'SHUNT COST': shunt_cost, 'INVOICE DIFF': '',
-                'Trailer total': trailer_cost, 'SHUNT Total': shunt_cost, 'Uploading WK': 'WK 01'
-            })
-
-    # --- Aggregate and Build Final DataFrames ---
+            total_litres.append(int(data_line_match.group(2).replace(',','')))
+            unit_prices.append(float(data_line_match.group(3)))
+            excl_gsts.append(float(data_line_match.group(4).replace(',','')))
+            shunt_qtys.append(shunt_data.get(docket_no, {}).get('shunt_qty', 0))
+
+            fy_wks.append(date_to_week.get(delivery_date, ''))
+            docket_nos.append(docket_no)
+            delivery_dates.append(delivery_date.strftime('%d-%b'))
+
+    # --- Derive Costs Column-wise ---
+    total_litres = np.asarray(total_litres, dtype=np.int64)
+    unit_prices = np.asarray(unit_prices, dtype=np.float64)
+    excl_gsts = np.asarray(excl_gsts, dtype=np.float64)
+    shunt_qtys = np.asarray(shunt_qtys, dtype=np.int64)
+    trailer_litres, shunt_costs, trailer_costs, total_trailer_cost_excl_gst, total_shunt_cost_excl_gst = \
+        _derive_costs(total_litres, unit_prices, shunt_qtys)
+
+    # --- Aggregate and Build Final Rows ---
     data_sheet_rows = []
     week_ending_date = last_delivery_date.strftime('%d/%m/%Y') if last_delivery_date else ''
-    week_lookup_date = last_delivery_date.strftime('%#d/%#m/%Y') if last_delivery_date else ''
-    week_code_row = financial_calendar_df[financial_calendar_df['Date'] == week_lookup_date]
-    fy_wk = week_code_row['Week'].iloc[0] if not week_code_row.empty else ''
+    fy_wk = date_to_week.get(last_delivery_date, '') if last_delivery_date else ''
 
     # Trailer Row (Aggregated)
     data_sheet_rows.append({
@@ -134,7 +211,7 @@ def _process_single_invoice(invoice_filename, vendor_df, financial_calendar_df,
         'Amount (Less GST)': f'{total_trailer_cost_excl_gst:.2f}', 'GST Amount': f'{(total_trailer_cost_excl_gst * 0.1):.2f}',
         'Invoice Total (Incl of GST)': f'{(total_trailer_cost_excl_gst * 1.1):.2f}',
         'Vendor Line Text (Optional) Not required for Zone Office Uploads': '',
-        'Store Line Text (Optional)': f'{vendor_name} 8409 {fy_wk} BRDC Fuel',
+        'Store Line Text (Optional)': TRAILER_LINE_PREFIX + str(fy_wk) + TRAILER_LINE_SUFFIX,
         'Comments': 'BRDC Fuel', 'Week Ending': week_ending_date, 'WeekCount Line Text': fy_wk
     })
     # Shunt Row (Aggregated, if applicable)
@@ -145,38 +222,40 @@ def _process_single_invoice(invoice_filename, vendor_df, financial_calendar_df,
             'Amount (Less GST)': f'{total_shunt_cost_excl_gst:.2f}', 'GST Amount': f'{(total_shunt_cost_excl_gst * 0.1):.2f}',
             'Invoice Total (Incl of GST)': f'{(total_shunt_cost_excl_gst * 1.1):.2f}',
             'Vendor Line Text (Optional) Not required for Zone Office Uploads': '',
-            'Store Line Text (Optional)': f'{vendor_name} 8682 {fy_wk} BRDC Shunt Fuel',
+            'Store Line Text (Optional)': SHUNT_LINE_PREFIX + str(fy_wk) + SHUNT_LINE_SUFFIX,
             'Comments': 'BRDC Shunt Fuel', 'Week Ending': week_ending_date, 'WeekCount Line Text': fy_wk
         })
 
-    data_sheet = pd.DataFrame(data_sheet_rows)
-    
     # --- Final Fuel Tracking Aggregation and Formatting ---
-    fuel_tracking_df = pd.DataFrame(fuel_tracking_rows)
-    if not fuel_tracking_df.empty:
-        invoice_total_trailer = fuel_tracking_df['Trailer total'].sum()
-        invoice_total_shunt_qty = fuel_tracking_df['SHUNT QTY'].sum()
-        invoice_total_excl_gst = fuel_tracking_df['excl GST'].sum()
-
-        # Now, format the columns for display
-        for col in ['excl GST', 'GST', 'incl GST', 'UNIT PRICE', 'SHUNT COST', 'Trailer total', 'SHUNT Total']:
-            fuel_tracking_df[col] = fuel_tracking_df[col].apply(lambda x: f'{x:.2f}' if col not in ['UNIT PRICE'] else f'{x:.5f}')
-
-        fuel_tracking_df['INVOICE DIFF'] = ''
-        last_row_index = fuel_tracking_df.index[-1]
-        fuel_tracking_df.loc[last_row_index, 'INVOICE DIFF'] = f'${invoice_total_excl_gst:.2f}'
-        fuel_tracking_df.loc[last_row_index, 'Trailer total'] = f'${invoice_total_trailer:.2f}'
-        fuel_tracking_df.loc[last_row_index, 'SHUNT Total'] = invoice_total_shunt_qty
+    # Kept as column arrays so process_files can build one DataFrame across all invoices
+    n_rows = len(docket_nos)
+    fuel_tracking_columns = {
+        'Invoice': np.full(n_rows, invoice_no, dtype=object), 'Invoice Date': np.full(n_rows, invoice_date, dtype=object),
+        'excl GST': excl_gsts, 'GST': excl_gsts * 0.1, 'incl GST': excl_gsts * 1.1,
+        'Delivery Date': np.array(delivery_dates, dtype=object), 'FY WK': np.array(fy_wks, dtype=object),
+        'Docket': np.array(docket_nos, dtype=object),
+        'Total Litres QTY': total_litres, 'SHUNT QTY': shunt_qtys, 'Trailer litres': trailer_litres,
+        'UNIT PRICE': unit_prices, 'SHUNT COST': shunt_costs, 'INVOICE DIFF': np.full(n_rows, '', dtype=object),
+        'Trailer total': trailer_costs, 'SHUNT Total': shunt_costs, 'Uploading WK': np.full(n_rows, 'WK 01', dtype=object)
+    }
+    if n_rows:
+        # Now, format the columns for display (object dtype so the totals below aren't truncated)
+        for col, fmt in FUEL_TRACKING_MONEY_FORMATS.items():
+            fuel_tracking_columns[col] = np.char.mod(fmt, fuel_tracking_columns[col]).astype(object)
+
+        fuel_tracking_columns['INVOICE DIFF'][-1] = f'${excl_gsts.sum():.2f}'
+        fuel_tracking_columns['Trailer total'][-1] = f'${total_trailer_cost_excl_gst:.2f}'
+        fuel_tracking_columns['SHUNT Total'][-1] = shunt_qtys.sum()
 
     total_excl_gst = total_trailer_cost_excl_gst + total_shunt_cost_excl_gst
-    checklist_sheet = pd.DataFrame([{
+    checklist_row = {
         'Vendor': vendor_name, 'Vendor #': vendor_no, 'Invoice No.': invoice_no,
         'Exc GST': f'{total_excl_gst:.2f}',
         'GST Amount': f'{(total_excl_gst * 0.1):.2f}',
         'Invoice Total (Incl of GST)': f'{(total_excl_gst * 1.1):.2f}'
-    }])
+    }
 
-    return data_sheet, checklist_sheet, fuel_tracking_df
+    return data_sheet_rows, checklist_row, fuel_tracking_columns
 
 # --- Routes (largely the same as before, just ensuring they call the new logic) ---
 @app.route('/', methods=['GET', 'POST'])
@@ -200,42 +279,70 @@ def process_files():
     docket_filenames = session.get('docket_filenames', [])
     if not invoice_filenames: return "No invoice files to process.", 400
 
-    shunt_data = {info['docket_number']: info for docket_filename in docket_filenames if (info := _process_shunt_docket(docket_filename))}
-    
-    vendor_df = pd.read_csv(VENDOR_LOOKUP_FILE)
-    financial_calendar_df = pd.read_csv(FINANCIAL_CALENDAR_FILE)
-    financial_calendar_df['Date'] = pd.to_datetime(financial_calendar_df['Date'], format='%d/%m/%Y').dt.strftime('%#d/%#m/%Y')
+    upload_folder = app.config['UPLOAD_FOLDER']
+    docket_paths = [os.path.join(upload_folder, f) for f in docket_filenames]
+    invoice_paths = [os.path.join(upload_folder, f) for f in invoice_filenames]
 
-    all_data, all_checklists, all_fuel_trackers = [], [], []
-    for filename in invoice_filenames:
-        data, check, fuel = _process_single_invoice(filename, vendor_df, financial_calendar_df, shunt_data)
-        if data is not None: all_data.append(data)
-        if check is not None: all_checklists.append(check)
-        if fuel is not None: all_fuel_trackers.append(fuel)
-
-    if not all_data: return "Could not process any invoices.", 500
-
-    session['data_sheet'] = pd.concat(all_data, ignore_index=True).to_json(orient='split')
-    session['checklist_sheet'] = pd.concat(all_checklists, ignore_index=True).to_json(orient='split')
-    session['fuel_tracking_sheet'] = pd.concat(all_fuel_trackers, ignore_index=True).to_json(orient='split')
-
-    return render_template('results.html', 
-                           data_sheet=pd.read_json(StringIO(session['data_sheet']), orient='split').to_html(classes='table table-striped', index=False),
-                           checklist_sheet=pd.read_json(StringIO(session['checklist_sheet']), orient='split').to_html(classes='table table-striped', index=False),
-                           fuel_tracking_sheet=pd.read_json(StringIO(session['fuel_tracking_sheet']), orient='split').to_html(classes='table table-striped', index=False))
+    # Extraction only pays for the pool hop on multi-file uploads with spare cores. When it does, every
+    # file is submitted up front so the pool keeps extracting while this process parses finished texts
+    all_data_rows, all_checklist_rows, all_fuel_columns = [], [], []
+    pool = None
+    try:
+        if PDF_POOL_WORKERS > 1 and len(docket_paths) + len(invoice_paths) > 1:
+            pool = _get_pdf_pool()
+            docket_results = pool.map(_process_shunt_docket, docket_paths)
+            invoice_futures = [pool.submit(extract_text_from_pdf, path) for path in invoice_paths]
+            invoice_texts = (future.result() for future in invoice_futures)
+        else:
+            docket_results = map(_process_shunt_docket, docket_paths)
+            invoice_texts = map(extract_text_from_pdf, invoice_paths)
+
+        shunt_data = {info['docket_number']: info for info in docket_results if info}
+
+        for text in invoice_texts:
+            data_rows, checklist_row, fuel_columns = _parse_invoice(text, DATE_TO_WEEK, shunt_data)
+            if data_rows is None: continue
+            all_data_rows.extend(data_rows)
+            all_checklist_rows.append(checklist_row)
+            all_fuel_columns.append(fuel_columns)
+    except BrokenProcessPool:
+        # Also covers a pool whose child died while idle: map/submit raise straight away
+        logging.error("PDF extraction pool broke; it will be recreated on the next request")
+        if pool is not None: _discard_pdf_pool(pool)
+        raise
+
+    if not all_data_rows: return "Could not process any invoices.", 500
+
+    data_df = pd.DataFrame(all_data_rows)
+    fuel_df = pd.DataFrame({col: np.concatenate([columns[col] for columns in all_fuel_columns]) for col in FUEL_TRACKING_COLUMNS})
+
+    # Write the combined CSV once on the server (shared by all gunicorn workers) and only keep its key in the session cookie
+    combined_csv = "".join([
+        pd.DataFrame(all_checklist_rows).to_csv(index=False),
+        "\n\n--- Data Sheet ---\n",
+        data_df.to_csv(index=False),
+        "\n\n--- Fuel Tracking Sheet ---\n",
+        fuel_df.to_csv(index=False),
+    ])
+    _sweep_old_results()
+    if 'result_key' in session: _remove_result(session['result_key'])
+    result_key = uuid.uuid4().hex
+    with open(_result_path(result_key), 'w', newline='', encoding='utf-8') as f:
+        f.write(combined_csv)
+    session['result_key'] = result_key
+
+    return render_template('results.html',
+                           data_columns=list(data_df.columns), data_rows=all_data_rows,
+                           checklist_columns=list(all_checklist_rows[0]), checklist_rows=all_checklist_rows,
+                           fuel_tracking_columns=FUEL_TRACKING_COLUMNS, fuel_tracking_rows=fuel_df.to_dict('records'))
 
 @app.route('/download_combined_csv')
 def download_combined_csv():
-    if 'data_sheet' not in session: return "Error: No data in session.", 404
-    data_df = pd.read_json(StringIO(session['data_sheet']), orient='split')
-    checklist_df = pd.read_json(StringIO(session['checklist_sheet']), orient='split')
-    fuel_df = pd.read_json(StringIO(session['fuel_tracking_sheet']), orient='split')
-    output = checklist_df.to_csv(index=False)
-    output += "\n\n--- Data Sheet ---\n"
-    output += data_df.to_csv(index=False)
-    output += "\n\n--- Fuel Tracking Sheet ---\n"
-    output += fuel_df.to_csv(index=False)
-    response = make_response(output)
+    result_key = session.get('result_key')
+    result_path = _result_path(result_key)
+    if not result_path or not os.path.exists(result_path): return "Error: No data in session.", 404
+    with open(result_path, 'rb') as f:
+        response = make_response(f.read())
     response.headers["Content-Disposition"] = "attachment; filename=combined_invoice_data.csv"
     response.headers["Content-Type"] = "text/csv"
     return response
@@ -246,5 +353,4 @@ def deployment():
 
 if __name__ == '__main__':
     if not os.path.exists(UPLOAD_FOLDER): os.makedirs(UPLOAD_FOLDER)
-    if not os.path.exists(KNOWLEDGE_BASE_PATH): os.makedirs(KNOWLEDGE_BASE_PATH)
     app.run(debug=True)